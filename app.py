@@ -2,8 +2,14 @@
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import mysql.connector
+from mysql.connector import errorcode
 from datetime import datetime, timedelta
+from collections import OrderedDict
+import threading
 import random
+import time
+import json
+import hashlib
 import os
 
 # Initialize Flask app
@@ -31,6 +37,242 @@ def get_db_connection():
         print(f"Error connecting to MySQL: {err}")
         return None
 
+# --- Idempotency Key Store ---
+# Clients may send an 'Idempotency-Key' header with /api/donate so that retries
+# after a timeout return the original result instead of recording the donation twice.
+# Recent results are kept in a bounded in-memory LRU; the `idempotency_keys` table is
+# the source of truth across restarts and multiple worker processes. Keys older than
+# IDEMPOTENCY_KEY_TTL_HOURS (measured from the key's `created_at`) are treated as absent.
+# They are purged by the background sweeper and, so that the table stays bounded even when
+# the sweeper isn't running, one chunk at a time on every IDEMPOTENCY_PURGE_EVERY-th keyed donation.
+# Each key is tied to a hash of the request, so reusing it for a different donation is rejected.
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 1024))
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+IDEMPOTENCY_PURGE_EVERY = int(os.environ.get('IDEMPOTENCY_PURGE_EVERY', 100))
+_idempotency_cache = OrderedDict() # {key: (body, status_code, request_hash, created_at)}
+_idempotency_lock = threading.Lock()
+_idempotency_keyed_donations = 0
+
+def idempotency_request_hash(user_email, data):
+    """Hashes the user and canonical JSON body a key was first used with."""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{user_email}\n{canonical}".encode('utf-8')).hexdigest()
+
+def idempotency_cutoff():
+    """Returns the creation time before which stored keys are considered expired."""
+    return datetime.now() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+
+def get_cached_idempotent_response(key):
+    """Returns the stored (body, status_code, request_hash) for a key from memory, or None."""
+    with _idempotency_lock:
+        entry = _idempotency_cache.get(key)
+        if entry is None:
+            return None
+        if entry[3] < idempotency_cutoff():
+            del _idempotency_cache[key]
+            return None
+        _idempotency_cache.move_to_end(key)
+        return entry[:3]
+
+def cache_idempotent_response(key, body, status_code, request_hash, created_at):
+    """Remembers a completed response in memory, evicting the oldest entry when full."""
+    with _idempotency_lock:
+        _idempotency_cache[key] = (body, status_code, request_hash, created_at)
+        _idempotency_cache.move_to_end(key)
+        while len(_idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            _idempotency_cache.popitem(last=False)
+
+def load_idempotency_key(cursor, key):
+    """
+    Reads the stored row for a key, expired or not, as
+    (body, status_code, request_hash, created_at), or None if there is no row.
+    body and status_code are None while the original request is still in progress.
+    """
+    cursor.execute(
+        "SELECT response_body, status_code, request_hash, created_at FROM idempotency_keys WHERE idem_key = %s",
+        (key,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    body = json.loads(row[0]) if row[0] is not None else None
+    return body, row[1], row[2], row[3]
+
+def should_purge_idempotency_keys():
+    """Returns True on every IDEMPOTENCY_PURGE_EVERY-th keyed donation in this process."""
+    global _idempotency_keyed_donations
+    with _idempotency_lock:
+        _idempotency_keyed_donations += 1
+        return _idempotency_keyed_donations % IDEMPOTENCY_PURGE_EVERY == 0
+
+def replay_idempotent_response(stored, request_hash):
+    """Returns the stored response, or 422 if the key was first used for a different request."""
+    body, status_code, stored_hash = stored[:3]
+    if stored_hash != request_hash:
+        return jsonify({"message": "Idempotency-Key was already used for a different request"}), 422
+    return jsonify(body), status_code
+
+# --- NGO Requirements Cache ---
+# /api/ngo_requirements/<id> responses are cached per NGO. Remaining quantities come from the
+# incrementally maintained `fulfilled_quantity` column, so reloading never recounts `donations`.
+# A committed donation drops the NGO's entry and bumps its version; a reader only stores what it
+# loaded if the version did not change meanwhile, so a load that raced a donation can't cache
+# old counts. The TTL bounds staleness when several worker processes run.
+NGO_REQUIREMENTS_CACHE_TTL_SECONDS = int(os.environ.get('NGO_REQUIREMENTS_CACHE_TTL_SECONDS', 30))
+_ngo_requirements_cache = {} # {ngo_id: (cached_at, response_body)}
+_ngo_requirements_versions = {} # {ngo_id: number of invalidations}
+_ngo_requirements_lock = threading.Lock()
+
+def get_cached_ngo_requirements(ngo_id):
+    """Returns the cached requirements response for an NGO, or None if missing or expired."""
+    with _ngo_requirements_lock:
+        entry = _ngo_requirements_cache.get(ngo_id)
+        if entry is None or time.monotonic() - entry[0] > NGO_REQUIREMENTS_CACHE_TTL_SECONDS:
+            return None
+        return entry[1]
+
+def get_ngo_requirements_version(ngo_id):
+    """Returns the current cache version for an NGO, to be passed to cache_ngo_requirements()."""
+    with _ngo_requirements_lock:
+        return _ngo_requirements_versions.get(ngo_id, 0)
+
+def cache_ngo_requirements(ngo_id, body, version):
+    """Stores a freshly loaded requirements response unless a donation invalidated it meanwhile."""
+    with _ngo_requirements_lock:
+        if _ngo_requirements_versions.get(ngo_id, 0) == version:
+            _ngo_requirements_cache[ngo_id] = (time.monotonic(), body)
+
+def invalidate_ngo_requirements(ngo_id):
+    """Drops the cached requirements for an NGO after a donation changed its quantities."""
+    with _ngo_requirements_lock:
+        _ngo_requirements_versions[ngo_id] = _ngo_requirements_versions.get(ngo_id, 0) + 1
+        _ngo_requirements_cache.pop(ngo_id, None)
+
+# --- Expired Row Sweeper ---
+# Expired OTPs are otherwise only removed when the same email calls verify_otp() again.
+# A daemon thread periodically deletes them in small chunks ordered by `expires_at`,
+# committing after each chunk so that no long-running transaction holds row locks.
+# The same thread purges idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS.
+# `python app.py` starts the thread in the serving process. Under `flask run` or a WSGI server
+# it only runs with START_SWEEPER=1, and with the debug reloader only in the serving child.
+# Multi-worker servers (e.g. Gunicorn with several workers) run one sweeper per worker, each
+# reporting its own metrics.
+SWEEP_INTERVAL_SECONDS = int(os.environ.get('SWEEP_INTERVAL_SECONDS', 60)) # 0 disables the sweeper
+SWEEP_CHUNK_SIZE = int(os.environ.get('SWEEP_CHUNK_SIZE', 500))
+SWEEP_CHUNK_PAUSE_SECONDS = 0.05 # Pause between chunks to let login traffic through
+
+sweeper_metrics = {
+    "runs": 0,
+    "chunks": 0,
+    "otps_deleted": 0,
+    "idempotency_keys_deleted": 0,
+    "errors": 0,
+    "last_run_started_at": None,
+    "last_run_duration_ms": None,
+    "last_run_otps_deleted": 0,
+}
+_sweeper_metrics_lock = threading.Lock()
+_sweeper_started = False
+
+def delete_in_chunks(sql, params, metric, max_chunks=None):
+    """
+    Runs a `DELETE ... ORDER BY ... LIMIT %s` statement repeatedly, committing after each
+    chunk, until fewer than SWEEP_CHUNK_SIZE rows are removed or max_chunks have run.
+    Returns the rows deleted and adds them to sweeper_metrics[metric].
+    """
+    conn = get_db_connection()
+    if conn is None:
+        raise mysql.connector.Error(msg="Database connection failed")
+
+    cursor = conn.cursor()
+    deleted = 0
+    chunks = 0
+    try:
+        while True:
+            # LIMIT keeps each transaction (and its locks) short
+            cursor.execute(sql, params + (SWEEP_CHUNK_SIZE,))
+            rowcount = cursor.rowcount
+            conn.commit()
+            chunks += 1
+            deleted += rowcount
+            if rowcount < SWEEP_CHUNK_SIZE or (max_chunks and chunks >= max_chunks):
+                break
+            time.sleep(SWEEP_CHUNK_PAUSE_SECONDS)
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        with _sweeper_metrics_lock:
+            sweeper_metrics["chunks"] += chunks
+            sweeper_metrics[metric] += deleted
+        cursor.close()
+        conn.close()
+    return deleted
+
+def sweep_expired_otps():
+    """Deletes expired OTP rows in chunks and returns the number of rows removed."""
+    # Uses the index on expires_at
+    return delete_in_chunks(
+        "DELETE FROM otps WHERE expires_at < %s ORDER BY expires_at LIMIT %s",
+        (datetime.now(),),
+        "otps_deleted"
+    )
+
+def purge_expired_idempotency_keys(max_chunks=None):
+    """Deletes idempotency keys older than the TTL in chunks and returns the number removed."""
+    # Uses the index on created_at
+    return delete_in_chunks(
+        "DELETE FROM idempotency_keys WHERE created_at < %s ORDER BY created_at LIMIT %s",
+        (idempotency_cutoff(),),
+        "idempotency_keys_deleted",
+        max_chunks
+    )
+
+def _sweeper_loop():
+    """
+    Runs sweep_expired_otps() and purge_expired_idempotency_keys() every
+    SWEEP_INTERVAL_SECONDS and records metrics.
+    """
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        started_at = datetime.now()
+        start = time.monotonic()
+        deleted = 0
+        try:
+            deleted = sweep_expired_otps()
+        except mysql.connector.Error as err:
+            print(f"Error sweeping expired OTPs: {err}")
+            with _sweeper_metrics_lock:
+                sweeper_metrics["errors"] += 1
+        try:
+            purge_expired_idempotency_keys()
+        except mysql.connector.Error as err:
+            print(f"Error purging expired idempotency keys: {err}")
+            with _sweeper_metrics_lock:
+                sweeper_metrics["errors"] += 1
+        with _sweeper_metrics_lock:
+            sweeper_metrics["runs"] += 1
+            sweeper_metrics["last_run_started_at"] = started_at.isoformat()
+            sweeper_metrics["last_run_duration_ms"] = round((time.monotonic() - start) * 1000, 1)
+            sweeper_metrics["last_run_otps_deleted"] = deleted
+
+def is_serving_process(debug):
+    """Returns False in the debug reloader's watcher process, which never serves requests."""
+    return not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+def start_sweeper():
+    """Starts the background expired-row sweeper thread once per process."""
+    global _sweeper_started
+    if _sweeper_started or SWEEP_INTERVAL_SECONDS <= 0:
+        return
+    _sweeper_started = True
+    threading.Thread(target=_sweeper_loop, name='expired-row-sweeper', daemon=True).start()
+
+# `python app.py` decides in the __main__ block below instead
+if __name__ != '__main__' and os.environ.get('START_SWEEPER') == '1':
+    if is_serving_process(os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true')):
+        start_sweeper()
+
 # --- API Endpoints ---
 
 @app.route('/')
@@ -162,6 +404,20 @@ def verify_otp():
         cursor.close()
         conn.close()
 
+@app.route('/api/metrics/sweeper', methods=['GET'])
+def get_sweeper_metrics():
+    """
+    Endpoint to expose the work done by the background sweeper (expired OTPs and idempotency keys).
+    """
+    with _sweeper_metrics_lock:
+        metrics = dict(sweeper_metrics)
+    metrics["enabled"] = _sweeper_started
+    metrics["interval_seconds"] = SWEEP_INTERVAL_SECONDS
+    metrics["chunk_size"] = SWEEP_CHUNK_SIZE
+    if not _sweeper_started:
+        metrics["warning"] = "Sweeper is not running in this process; set START_SWEEPER=1 when using flask run or a WSGI server."
+    return jsonify(metrics), 200
+
 @app.route('/api/ngos', methods=['GET'])
 def get_ngos():
     """
@@ -209,8 +465,15 @@ def get_total_donors():
 @app.route('/api/ngo_requirements/<int:ngo_id>', methods=['GET'])
 def get_ngo_requirements(ngo_id):
     """
-    Endpoint to fetch requirements for a specific NGO, grouped by category.
+    Endpoint to fetch requirements for a specific NGO, grouped by category,
+    along with the quantity of each item still needed.
     """
+    cached = get_cached_ngo_requirements(ngo_id)
+    if cached:
+        return jsonify(cached), 200
+    # Taken before reading so that a donation committing during the read is detected
+    cache_version = get_ngo_requirements_version(ngo_id)
+
     conn = get_db_connection()
     if conn is None:
         return jsonify({"message": "Database connection failed"}), 500
@@ -224,24 +487,32 @@ def get_ngo_requirements(ngo_id):
         ngo_name = ngo_name_result['name']
 
         cursor.execute(
-            "SELECT category, item_name FROM ngo_requirements WHERE ngo_id = %s ORDER BY category, item_name",
+            """
+            SELECT category, item_name, needed_quantity - fulfilled_quantity AS remaining
+            FROM ngo_requirements WHERE ngo_id = %s ORDER BY category, item_name
+            """,
             (ngo_id,)
         )
         requirements = cursor.fetchall()
 
         # Group requirements by category
         grouped_requirements = {}
+        remaining = {}
         for req in requirements:
             category = req['category']
             if category not in grouped_requirements:
                 grouped_requirements[category] = []
             grouped_requirements[category].append(req['item_name'])
+            remaining[req['item_name']] = req['remaining']
 
-        return jsonify({
+        response_body = {
             "ngo_id": ngo_id,
             "ngo_name": ngo_name,
-            "requirements": grouped_requirements
-        }), 200
+            "requirements": grouped_requirements,
+            "remaining": remaining # {item_name: quantity still needed, or None if open-ended}
+        }
+        cache_ngo_requirements(ngo_id, response_body, cache_version)
+        return jsonify(response_body), 200
     except mysql.connector.Error as err:
         print(f"Error fetching NGO requirements: {err}")
         return jsonify({"message": "Failed to fetch NGO requirements", "error": str(err)}), 500
@@ -268,12 +539,71 @@ def handle_donation():
     if not all([user_email, ngo_id, action_type, selected_items]):
         return jsonify({"message": "Missing required data"}), 400
 
+    try:
+        ngo_id = int(ngo_id)
+    except (TypeError, ValueError):
+        return jsonify({"message": "Invalid NGO ID"}), 400
+
+    # Total quantity per item, validated before touching the database
+    item_quantities = {}
+    for item_data in selected_items:
+        quantity = item_data.get('quantity', 1)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            return jsonify({"message": "Item quantities must be positive integers"}), 400
+        item_name = item_data.get('item')
+        if not item_name:
+            return jsonify({"message": "Each selected item must have a name"}), 400
+        item_quantities[item_name] = item_quantities.get(item_name, 0) + quantity
+
+    # Optional idempotency key so that client retries don't record the donation twice
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        idempotency_key = idempotency_key.strip()
+        if not idempotency_key or len(idempotency_key) > 255:
+            return jsonify({"message": "Invalid Idempotency-Key header"}), 400
+        request_hash = idempotency_request_hash(user_email, data)
+        cached = get_cached_idempotent_response(idempotency_key)
+        if cached:
+            return replay_idempotent_response(cached, request_hash)
+        purge_idempotency_keys = should_purge_idempotency_keys()
+
     conn = get_db_connection()
     if conn is None:
         return jsonify({"message": "Database connection failed"}), 500
 
     cursor = conn.cursor()
     try:
+        if idempotency_key:
+            stored = load_idempotency_key(cursor, idempotency_key)
+            if stored and stored[3] < idempotency_cutoff():
+                # An expired key that hasn't been purged yet is treated as absent. Only delete
+                # when a row was actually found: a DELETE matching nothing would take a gap lock
+                # that can deadlock with a concurrent INSERT of a nearby key.
+                cursor.execute(
+                    "DELETE FROM idempotency_keys WHERE idem_key = %s AND created_at < %s",
+                    (idempotency_key, idempotency_cutoff())
+                )
+            elif stored and stored[0] is not None:
+                cache_idempotent_response(idempotency_key, *stored)
+                return replay_idempotent_response(stored, request_hash)
+            # Claim the key inside this transaction. A concurrent retry with the same key
+            # blocks here on the primary key and fails with a duplicate once we commit.
+            # created_at is set here (TIMESTAMP has whole-second precision) so the in-memory
+            # entry can expire together with the database row.
+            claimed_at = datetime.now().replace(microsecond=0)
+            try:
+                cursor.execute(
+                    "INSERT INTO idempotency_keys (idem_key, request_hash, created_at) VALUES (%s, %s, %s)",
+                    (idempotency_key, request_hash, claimed_at)
+                )
+            except mysql.connector.IntegrityError:
+                conn.rollback()
+                stored = load_idempotency_key(cursor, idempotency_key)
+                if stored and stored[0] is not None and stored[3] >= idempotency_cutoff():
+                    cache_idempotent_response(idempotency_key, *stored)
+                    return replay_idempotent_response(stored, request_hash)
+                return jsonify({"message": "A request with this Idempotency-Key is already in progress"}), 409
+
         # Get user_id from email
         cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
         user_result = cursor.fetchone()
@@ -304,6 +634,32 @@ def handle_donation():
             
             resale_amount = original_cost * resale_percentage
 
+        # Reserve quantities atomically: the conditional UPDATE only succeeds while enough
+        # is still needed, so concurrent donations can never over-fulfil a requirement.
+        # Requirements without a needed_quantity are open-ended and accept any quantity.
+        # Items are reserved in a fixed order to avoid deadlocks between multi-item donations.
+        for item_name in sorted(item_quantities):
+            quantity = item_quantities[item_name]
+            cursor.execute(
+                """
+                UPDATE ngo_requirements SET fulfilled_quantity = fulfilled_quantity + %s
+                WHERE ngo_id = %s AND item_name = %s
+                AND (needed_quantity IS NULL OR fulfilled_quantity + %s <= needed_quantity)
+                """,
+                (quantity, ngo_id, item_name, quantity)
+            )
+            if cursor.rowcount == 0:
+                # Tell items the NGO never asked for apart from ones already fulfilled
+                cursor.execute(
+                    "SELECT 1 FROM ngo_requirements WHERE ngo_id = %s AND item_name = %s",
+                    (ngo_id, item_name)
+                )
+                is_requirement = cursor.fetchone() is not None
+                conn.rollback()
+                if not is_requirement:
+                    return jsonify({"message": f"'{item_name}' is not a requirement of this NGO."}), 400
+                return jsonify({"message": f"'{item_name}' is no longer needed in that quantity by this NGO."}), 409
+
         # Insert each selected item as a separate donation record
         for item_data in selected_items:
             item_category = item_data.get('category')
@@ -327,11 +683,34 @@ def handle_donation():
             ON DUPLICATE KEY UPDATE total_donors = total_donors + 1
             """
         )
+
+        response_body = {"message": f"Thank you for your {action_type}! Your contribution has been recorded."}
+        if idempotency_key:
+            # Store the result in the same transaction as the writes it describes
+            cursor.execute(
+                "UPDATE idempotency_keys SET response_body = %s, status_code = %s WHERE idem_key = %s",
+                (json.dumps(response_body), 200, idempotency_key)
+            )
         conn.commit()
 
-        return jsonify({"message": f"Thank you for your {action_type}! Your contribution has been recorded."}), 200
+        invalidate_ngo_requirements(ngo_id)
+        if idempotency_key:
+            cache_idempotent_response(idempotency_key, response_body, 200, request_hash, claimed_at)
+            if purge_idempotency_keys:
+                # Keeps the table bounded even when the background sweeper isn't running
+                try:
+                    purge_expired_idempotency_keys(max_chunks=1)
+                except mysql.connector.Error as err:
+                    print(f"Error purging expired idempotency keys: {err}")
+        return jsonify(response_body), 200
 
     except mysql.connector.Error as err:
+        if err.errno in (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT):
+            # Lost a lock race with a concurrent donation; nothing was recorded, so retrying is safe
+            conn.rollback()
+            print(f"Lock conflict handling donation: {err}")
+            return jsonify({"message": "Another request is being processed. Please try again."}), 409
+
         conn.rollback()
         print(f"Error handling donation: {err}")
         return jsonify({"message": f"Failed to process {action_type}", "error": str(err)}), 500
@@ -347,9 +726,17 @@ if __name__ == '__main__':
     # export DB_PASSWORD='your_password'
     # export DB_DATABASE='realpage_donations'
     
+    # export FLASK_DEBUG='0' # Debug mode (with the reloader) is on by default
+    
     # For development, you can run: flask run
     # For production, use a WSGI server like Gunicorn or uWSGI
-    app.run(debug=True, port=5000)
+    # Under flask run or a WSGI server, also export START_SWEEPER='1' to purge expired OTPs and
+    # idempotency keys in the background (python app.py starts the sweeper by itself)
+    debug = os.environ.get('FLASK_DEBUG', '1').lower() in ('1', 'true')
+    # With the debug reloader, only start the sweeper in the serving child process
+    if is_serving_process(debug):
+        start_sweeper()
+    app.run(debug=debug, port=5000)
 
 
 
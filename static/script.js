@@ -1,6 +1,8 @@
 // script.js
 document.addEventListener('DOMContentLoaded', () => {
     const API_BASE_URL = 'http://127.0.0.1:5000/api';
+    const DONATION_REQUEST_TIMEOUT_MS = 8000; // Abort a donation attempt that takes longer than this
+    const DONATION_RETRY_BACKOFF_MS = 500; // Doubled after each failed attempt
 
     // Get elements for login page
     const loginPage = document.getElementById('login-page');
@@ -268,12 +270,14 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- NGO Details Page Logic ---
-    async function showNgoDetailsPage(ngoId) {
+    async function showNgoDetailsPage(ngoId, keepActionMessage = false) {
         showPage('ngo-details-page');
         ngoDetailsTitle.textContent = 'Loading NGO Details...';
         ngoRequirementsSections.innerHTML = '<div class="text-center text-gray-600 text-lg py-4">Loading requirements...</div>';
-        actionMessageDisplay.textContent = ''; // Clear previous action message
-        actionMessageDisplay.className = 'mt-6 text-center font-semibold text-lg p-3 rounded-lg'; // Reset styles
+        if (!keepActionMessage) {
+            actionMessageDisplay.textContent = ''; // Clear previous action message
+            actionMessageDisplay.className = 'mt-6 text-center font-semibold text-lg p-3 rounded-lg'; // Reset styles
+        }
         originalCostField.value = '';
         purchaseYearField.value = '';
         selectedItemsForDonation = {}; // Reset selected items
@@ -299,11 +303,15 @@ document.addEventListener('DOMContentLoaded', () => {
                     
                     const itemsDiv = categoryDiv.querySelector('div.flex-wrap');
                     data.requirements[category].forEach(item => {
+                        // null/undefined remaining means the requirement is open-ended
+                        const remaining = data.remaining ? data.remaining[item] : undefined;
+                        const isFulfilled = remaining != null && remaining <= 0;
+                        const remainingText = remaining == null ? '' : (isFulfilled ? ' (fulfilled)' : ` (${remaining} needed)`);
                         const itemContainer = document.createElement('div');
                         itemContainer.className = 'flex items-center';
                         itemContainer.innerHTML = `
-                            <input type="checkbox" id="item-${category.replace(/\s/g, '-')}-${item.replace(/\s/g, '-')}" data-category="${category}" data-item="${item}" class="form-checkbox h-5 w-5 text-blue-600 rounded focus:ring-blue-500" />
-                            <label for="item-${category.replace(/\s/g, '-')}-${item.replace(/\s/g, '-')}" class="ml-2 text-gray-700 text-lg cursor-pointer">${item}</label>
+                            <input type="checkbox" id="item-${category.replace(/\s/g, '-')}-${item.replace(/\s/g, '-')}" data-category="${category}" data-item="${item}" class="form-checkbox h-5 w-5 text-blue-600 rounded focus:ring-blue-500" ${isFulfilled ? 'disabled' : ''} />
+                            <label for="item-${category.replace(/\s/g, '-')}-${item.replace(/\s/g, '-')}" class="ml-2 text-gray-700 text-lg cursor-pointer${isFulfilled ? ' line-through text-gray-400' : ''}">${item}${remainingText}</label>
                         `;
                         itemsDiv.appendChild(itemContainer);
 
@@ -358,6 +366,37 @@ document.addEventListener('DOMContentLoaded', () => {
     originalCostField.addEventListener('input', updateActionButtonsState);
     purchaseYearField.addEventListener('input', updateActionButtonsState);
 
+    // crypto.randomUUID() is only available in secure contexts (HTTPS or localhost)
+    function generateIdempotencyKey() {
+        if (window.crypto && typeof crypto.randomUUID === 'function') {
+            return crypto.randomUUID();
+        }
+        const bytes = crypto.getRandomValues(new Uint8Array(16));
+        return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function postDonationWithRetry(payload, idempotencyKey, retries = 2) {
+        for (let attempt = 0; ; attempt++) {
+            const controller = new AbortController();
+            const timeoutId = setTimeout(() => controller.abort(), DONATION_REQUEST_TIMEOUT_MS);
+            try {
+                return await fetch(`${API_BASE_URL}/donate`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey },
+                    body: JSON.stringify(payload),
+                    signal: controller.signal
+                });
+            } catch (error) {
+                // Network failure or timeout: the request may or may not have reached the server,
+                // retrying with the same key is safe
+                if (attempt >= retries) throw error;
+                await new Promise(resolve => setTimeout(resolve, DONATION_RETRY_BACKOFF_MS * 2 ** attempt));
+            } finally {
+                clearTimeout(timeoutId);
+            }
+        }
+    }
+
     async function handleDonationAction(actionType) {
         actionMessageDisplay.textContent = '';
         actionMessageDisplay.className = 'mt-6 text-center font-semibold text-lg p-3 rounded-lg'; // Reset styles
@@ -415,28 +454,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         try {
-            const response = await fetch(`${API_BASE_URL}/donate`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(payload)
-            });
+            // One key per submission: retries of this same submission reuse it, so the server
+            // returns the original result instead of recording the donation twice.
+            const idempotencyKey = generateIdempotencyKey();
+            const response = await postDonationWithRetry(payload, idempotencyKey);
             const data = await response.json();
 
             if (response.ok) {
                 actionMessageDisplay.textContent = data.message;
                 actionMessageDisplay.classList.add('text-green-700', 'bg-green-100', 'border', 'border-green-300');
-                // Clear selections and reset fields after successful submission
-                selectedItemsForDonation = {};
-                originalCostField.value = '';
-                purchaseYearField.value = '';
-                // Deselect all checkboxes
-                document.querySelectorAll('#ngo-requirements-sections input[type="checkbox"]').forEach(checkbox => {
-                    checkbox.checked = false;
-                });
                 await fetchTotalDonors(); // Update donor count on dashboard
+                // Reload requirements so remaining counts are current; this also clears selections and fields
+                await showNgoDetailsPage(currentSelectedNgoId, true);
             } else {
                 actionMessageDisplay.textContent = data.message;
                 actionMessageDisplay.classList.add('text-red-700', 'bg-red-100', 'border', 'border-red-300');
+                if (response.status === 409) {
+                    // The requirement was fulfilled meanwhile: show the current remaining counts
+                    await showNgoDetailsPage(currentSelectedNgoId, true);
+                }
             }
         } catch (error) {
             console.error('Error processing action:', error);